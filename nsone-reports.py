@@ -1,18 +1,78 @@
 #!/usr/bin/env python3
 import argparse
 import configparser
+import io
 import logging
 import smtplib
-from datetime import datetime, timedelta
+import time
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from itertools import chain
 from pathlib import Path
 from sys import exit as sys_exit
+from sys import stdout
 
+import ijson
 import yaml
-from jinja2 import Environment, FileSystemLoader, select_autoescape
+
+try:
+    from orjson import dumps as _json_dumps
+    from orjson import loads as _json_loads
+except ImportError:
+    import json
+
+    _json_loads = json.loads
+
+    def _json_dumps(obj):
+        return json.dumps(obj).encode("utf-8")
+
+try:
+    from yaml import CSafeDumper as _SafeDumper
+    from yaml import CSafeLoader as _SafeLoader
+except ImportError:
+    from yaml import SafeDumper as _SafeDumper
+    from yaml import SafeLoader as _SafeLoader
+
+from jinja2 import (
+    Environment,
+    FileSystemBytecodeCache,
+    FileSystemLoader,
+    select_autoescape,
+)
 from requests import Session as reqSession
+from requests.adapters import HTTPAdapter
+
+_UNIT_SECONDS = {
+    "microseconds": 1e-6,
+    "milliseconds": 1e-3,
+    "seconds": 1,
+    "minutes": 60,
+    "hours": 3600,
+    "days": 86400,
+    "weeks": 604800,
+}
+
+_SESSION = reqSession()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=10))
+
+_JINJA_ENV = None
+_REPORT_TEMPLATE = None
+
+
+def _get_template():
+    global _JINJA_ENV, _REPORT_TEMPLATE
+    if _REPORT_TEMPLATE is None:
+        cache_dir = Path("~/.cache/nsone_reports/jinja").expanduser()
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        _JINJA_ENV = Environment(
+            loader=FileSystemLoader(
+                Path(__file__).resolve().parent.joinpath("templates")
+            ),
+            autoescape=select_autoescape(["html"]),
+            bytecode_cache=FileSystemBytecodeCache(directory=str(cache_dir)),
+        )
+        _REPORT_TEMPLATE = _JINJA_ENV.get_template("nsone-report.html.j2")
+    return _REPORT_TEMPLATE
 
 
 def parse_args():
@@ -47,6 +107,12 @@ def parse_args():
     parser.add_argument(
         "--config", help="path to config file", default="~/.nsone_reports.ini"
     )
+    parser.add_argument(
+        "--output-format",
+        default="yaml",
+        choices=["yaml", "jsonl"],
+        help="format of the parsed report (default: %(default)s)",
+    )
     parser_export = parser.add_argument_group()
     parser_export.add_argument(
         "--export",
@@ -76,6 +142,10 @@ def parse_args():
     return parser.parse_args()
 
 
+def _yaml_load(stream):
+    return yaml.load(stream, Loader=_SafeLoader)
+
+
 def parse_config(path):
     cfg = Path(path).expanduser()
     if cfg.exists():
@@ -87,117 +157,164 @@ def parse_config(path):
         sys_exit(f"Config file {path} not found!")
 
 
-def get_reports(api_key, unit="hours", amount=1, limit=20, export=None, fmt=None):
-    with reqSession() as s:
-        s.headers["X-NSONE-Key"] = api_key
-        s.headers["charset"] = "utf-8"
-        epoch = datetime(1970, 1, 1)
-        td_args = {unit: amount}
-        d = datetime.utcnow() - timedelta(**td_args)
-        start_from = int((d - epoch).total_seconds())
-        params = {
-            "start": start_from,
-            "limit": limit,
-        }
-        if export:
-            params["export"] = fmt
-        try:
-            r = s.get("https://api.nsone.net/v1/account/activity", params=params)
-        except Exception as e:
-            logging.error(e)
-            sys_exit(e)
+def configure_session(api_key):
+    _SESSION.headers["X-NSONE-Key"] = api_key
+    _SESSION.headers["charset"] = "utf-8"
+
+
+def get_reports(unit="hours", amount=1, limit=20, export=None, fmt=None):
+    start_from = int(time.time() - amount * _UNIT_SECONDS[unit])
+    params = {
+        "start": start_from,
+        "limit": limit,
+    }
+    if export:
+        params["export"] = fmt
+    try:
+        r = _SESSION.get(
+            "https://api.nsone.net/v1/account/activity", params=params, stream=True
+        )
+    except Exception as e:
+        logging.error(e)
+        sys_exit(e)
     if r.status_code == 200:
-        return r.content if export else r.json()
+        if export:
+            return r.content
+        r.raw.decode_content = True
+        # use_float keeps JSON floats as float; the default Decimal is not
+        # representable by SafeDumper or orjson
+        return ijson.items(r.raw, "item", use_float=True)
     else:
-        logging.error(f"r.json() = {r.json()}")
-        return r.json().get("message")
+        error = _json_loads(r.content)
+        logging.error(f"error = {error}")
+        return error.get("message")
 
 
 def convert_timestamp(timestamp, fmt="%d.%m.%Y %H:%M:%S"):
-    dt_object = datetime.fromtimestamp(int(timestamp))
-    return dt_object.strftime(fmt)
+    return time.strftime(fmt, time.localtime(timestamp))
 
 
-def parse_reports(reports):
-    output = []
-    if len(reports) != -1:
-        for item in reports:
-            logging.debug(f"item = {item}")
-            try:
-                result = {}
-                output.append("---\n")
-                result["user_name"] = item.get("user_name")
-                result["user_id"] = item.get("user_id")
-                if item.get("zone"):
-                    result["zone"] = item["resource"].get("zone")
-                result["time"] = convert_timestamp(item.get("timestamp"))
-                result["action"] = item.get("action")
-                if item["resource"].get("type"):
-                    result["type"] = item["resource"].get("type")
-                if item["resource"].get("domain"):
-                    result["domain"] = item["resource"].get("domain")
-                if item["resource"].get("answers"):
-                    result["answers"] = list(
-                        chain.from_iterable(
-                            [i["answer"] for i in item["resource"]["answers"]]
-                        )
-                    )
-                else:
-                    result["resource"] = item.get("resource")
-                output.append(yaml.dump(result, sort_keys=False, allow_unicode=True))
-                output.append("\n")
-            except KeyError as e:
-                logging.error(f"item = {item}")
-                sys_exit(e)
-
-    return "".join(output)
-
-
-def send_mail(
-    mailfrom,
-    mailto,
-    server,
-    user,
-    password,
-    body,
-    header="NS1 Activity Report",
-    footer="",
-    formatting=None,
-    port=465,
-):
-    toaddrs = mailto.split(",")
-    message = MIMEMultipart("alternative")
-    message["Subject"] = header
-    message["From"] = mailfrom
-    message["To"] = mailto
-    # TODO attachment pdf xlsx
-    message.attach(MIMEText(body, "plain", "utf-8"))
-    if formatting == "html":
-        html_part = MIMEText(body, "html", "utf-8")
-        message.attach(html_part)
+def build_result(item):
+    resource = item.get("resource") or {}
+    zone = resource.get("zone")
+    rtype = resource.get("type")
+    domain = resource.get("domain")
+    answers = resource.get("answers")
+    result = {
+        "user_name": item.get("user_name"),
+        "user_id": item.get("user_id"),
+    }
+    if zone:
+        result["zone"] = zone
+    result["time"] = convert_timestamp(item.get("timestamp"))
+    result["action"] = item.get("action")
+    if rtype:
+        result["type"] = rtype
+    if domain:
+        result["domain"] = domain
+    if answers:
+        result["answers"] = list(chain.from_iterable(i["answer"] for i in answers))
     else:
-        plain_part = MIMEText(body, "plain", "utf-8")
-        env = Environment(
-            loader=FileSystemLoader(
-                Path(__file__).resolve().parent.joinpath("templates")
-            ),
-            autoescape=select_autoescape(["html"]),
-        )
-        template = env.get_template("nsone-report.html.j2")
-        html_part = MIMEText(
-            template.render(body=body, title=header, footer=footer), "html", "utf-8"
-        )
-        message.attach(plain_part)
+        result["resource"] = resource
+    return result
+
+
+def _iter_results(reports):
+    for item in reports:
+        logging.debug(f"item = {item}")
+        try:
+            yield build_result(item)
+        except KeyError as e:
+            logging.error(f"item = {item}")
+            sys_exit(e)
+
+
+def dump_reports(reports, stream, output_format="yaml"):
+    if output_format == "jsonl":
+        for result in _iter_results(reports):
+            stream.write(_json_dumps(result))
+            stream.write(b"\n")
+        return
+    yaml.dump_all(
+        _iter_results(reports),
+        stream,
+        Dumper=_SafeDumper,
+        sort_keys=False,
+        allow_unicode=True,
+        explicit_start=True,
+        encoding="utf-8",
+    )
+
+
+def parse_reports(reports, output_format="yaml"):
+    buf = io.BytesIO()
+    dump_reports(reports, buf, output_format)
+    return buf.getvalue().decode("utf-8")
+
+
+class Mailer:
+    def __init__(self, server, port=465, user=None, password=None):
+        self.server = server
+        self.port = port
+        self.user = user
+        self.password = password
+        self._conn = None
+
+    def _connect(self):
+        conn = smtplib.SMTP_SSL(self.server, self.port)
+        if self.user and self.password:
+            conn.login(self.user, self.password)
+        return conn
+
+    def _get_connection(self):
+        if self._conn is None:
+            self._conn = self._connect()
+        else:
+            try:
+                self._conn.noop()
+            except smtplib.SMTPServerDisconnected:
+                self._conn = self._connect()
+        return self._conn
+
+    def send(
+        self,
+        mailfrom,
+        mailto,
+        body,
+        header="NS1 Activity Report",
+        footer="",
+        formatting=None,
+    ):
+        toaddrs = mailto.split(",")
+        message = MIMEMultipart("alternative")
+        message["Subject"] = header
+        message["From"] = mailfrom
+        message["To"] = mailto
+        # TODO attachment pdf xlsx
+        message.attach(MIMEText(body, "plain", "utf-8"))
+        if formatting == "html":
+            html_part = MIMEText(body, "html", "utf-8")
+        else:
+            template = _get_template()
+            html_part = MIMEText(
+                template.render(body=body, title=header, footer=footer),
+                "html",
+                "utf-8",
+            )
         message.attach(html_part)
-    server = smtplib.SMTP_SSL(server, port)
-    if user and password:
-        server.login(user, password)
-    try:
-        server.sendmail(mailfrom, toaddrs, message.as_string())
-    except Exception as e:
-        sys_exit(e)
-    finally:
-        server.quit()
+        conn = self._get_connection()
+        try:
+            conn.sendmail(mailfrom, toaddrs, message.as_string())
+        except Exception as e:
+            sys_exit(e)
+
+    def close(self):
+        if self._conn is not None:
+            try:
+                self._conn.quit()
+            except smtplib.SMTPServerDisconnected:
+                pass
+            self._conn = None
 
 
 if __name__ == "__main__":
@@ -220,8 +337,8 @@ if __name__ == "__main__":
         logging.error(f"Permission denied for {log_path}")
         sys_exit(str(e))
 
+    configure_session(config.get("nsone", "NSONE_API_KEY"))
     report_params = {
-        "api_key": config.get("nsone", "NSONE_API_KEY"),
         "unit": args.unit,
         "amount": args.amount,
         "limit": args.limit,
@@ -230,12 +347,26 @@ if __name__ == "__main__":
     }
     logging.debug(f"report_params = {report_params}")
     report = get_reports(**report_params)
-    logging.debug(f"report = {report}")
-    parsed_reports = parse_reports(report) if not args.export else report
-
+    if args.export:
+        # non-export reports are a lazy stream; records are logged one by
+        # one in _iter_results instead
+        logging.debug(f"report = {report}")
     # TODO save exports to file
-    if not args.mailto or args.silent:
-        print(parsed_reports if not args.export else parsed_reports.decode("utf-8"))
+    if not args.export and not args.mailto:
+        parsed_reports = ""
+        if not args.silent:
+            # reports stream straight to stdout without an intermediate str
+            dump_reports(report, stdout.buffer, args.output_format)
+    else:
+        parsed_reports = (
+            parse_reports(report, args.output_format) if not args.export else report
+        )
+        if not args.mailto or args.silent:
+            print(
+                parsed_reports
+                if not args.export
+                else parsed_reports.decode("utf-8")
+            )
 
     if args.mailto and len(parsed_reports) != 0:
         mail_params = {
@@ -251,11 +382,16 @@ if __name__ == "__main__":
             "mailto": args.mailto
             if args.mailto
             else config.get("smtp", "mailto", fallback=None),
-            "server": config.get("smtp", "server", fallback="localhost"),
-            "user": config.get("smtp", "username", fallback=None),
-            "password": config.get("smtp", "password", fallback=None),
             "body": parsed_reports,
             "formatting": args.format if args.export else None,
-            "port": config.getint("smtp", "port", fallback=465),
         }
-        send_mail(**mail_params)
+        mailer = Mailer(
+            server=config.get("smtp", "server", fallback="localhost"),
+            port=config.getint("smtp", "port", fallback=465),
+            user=config.get("smtp", "username", fallback=None),
+            password=config.get("smtp", "password", fallback=None),
+        )
+        try:
+            mailer.send(**mail_params)
+        finally:
+            mailer.close()